@@ -4,9 +4,11 @@ import srt
 import datetime
 import json
 import enum
+import time
+import shutil
 
 import requests
-from urllib.request import urlretrieve
+from urllib.request import urlopen
 from zipfile import ZipFile
 from re import match
 from pathlib import Path
@@ -18,6 +20,8 @@ MODEL_PRE_URL = "https://alphacephei.com/vosk/models/"
 MODEL_LIST_URL = MODEL_PRE_URL + "model-list.json"
 MODEL_DIRS = [os.getenv("VOSK_MODEL_PATH"), Path("/usr/share/vosk"),
         Path.home() / "AppData/Local/vosk", Path.home() / ".cache/vosk"]
+MODEL_LIST_CACHE = Path.home() / ".cache/vosk/model-list.json"
+MODEL_LIST_TTL = 24 * 60 * 60
 
 def open_dll():
     dlldir = os.path.abspath(os.path.dirname(__file__))
@@ -36,14 +40,35 @@ def open_dll():
 
 _c = open_dll()
 
-def list_models():
+_model_list = None
+
+def get_model_list():
+    global _model_list
+    if _model_list is not None:
+        return _model_list
+    try:
+        if time.time() - MODEL_LIST_CACHE.stat().st_mtime < MODEL_LIST_TTL:
+            with open(MODEL_LIST_CACHE, "r", encoding="utf-8") as fh:
+                _model_list = json.load(fh)
+                return _model_list
+    except (OSError, ValueError):
+        pass
     response = requests.get(MODEL_LIST_URL, timeout=10)
-    for model in response.json():
+    _model_list = response.json()
+    try:
+        MODEL_LIST_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        with open(MODEL_LIST_CACHE, "w", encoding="utf-8") as fh:
+            json.dump(_model_list, fh)
+    except OSError:
+        pass
+    return _model_list
+
+def list_models():
+    for model in get_model_list():
         print(model["name"])
 
 def list_languages():
-    response = requests.get(MODEL_LIST_URL, timeout=10)
-    languages = {m["lang"] for m in response.json()}
+    languages = {m["lang"] for m in get_model_list()}
     for lang in languages:
         print (lang)
 
@@ -64,14 +89,16 @@ class Model:
     def vosk_model_find_word(self, word):
         return _c.vosk_model_find_word(self._handle, word.encode("utf-8"))
 
-    def get_model_path(self, model_name, lang):
+    @classmethod
+    def get_model_path(cls, model_name, lang):
         if model_name is None:
-            model_path = self.get_model_by_lang(lang)
+            model_path = cls.get_model_by_lang(lang)
         else:
-            model_path = self.get_model_by_name(model_name)
+            model_path = cls.get_model_by_name(model_name)
         return str(model_path)
 
-    def get_model_by_name(self, model_name):
+    @classmethod
+    def get_model_by_name(cls, model_name):
         for directory in MODEL_DIRS:
             if directory is None or not Path(directory).exists():
                 continue
@@ -79,16 +106,16 @@ class Model:
             model_file = [model for model in model_file_list if model == model_name]
             if model_file != []:
                 return Path(directory, model_file[0])
-        response = requests.get(MODEL_LIST_URL, timeout=10)
-        result_model = [model["name"] for model in response.json() if model["name"] == model_name]
+        result_model = [model["name"] for model in get_model_list() if model["name"] == model_name]
         if result_model == []:
             print("model name %s does not exist" % (model_name))
             sys.exit(1)
         else:
-            self.download_model(Path(directory, result_model[0]))
+            cls.download_model(Path(directory, result_model[0]))
             return Path(directory, result_model[0])
 
-    def get_model_by_lang(self, lang):
+    @classmethod
+    def get_model_by_lang(cls, lang):
         for directory in MODEL_DIRS:
             if directory is None or not Path(directory).exists():
                 continue
@@ -97,39 +124,32 @@ class Model:
                     match(r"vosk-model(-small)?-{}".format(lang), model)]
             if model_file != []:
                 return Path(directory, model_file[0])
-        response = requests.get(MODEL_LIST_URL, timeout=10)
-        result_model = [model["name"] for model in response.json() if
+        result_model = [model["name"] for model in get_model_list() if
                 model["lang"] == lang and model["type"] == "small" and model["obsolete"] == "false"]
         if result_model == []:
             print("lang %s does not exist" % (lang))
             sys.exit(1)
         else:
-            self.download_model(Path(directory, result_model[0]))
+            cls.download_model(Path(directory, result_model[0]))
             return Path(directory, result_model[0])
 
-    def download_model(self, model_name):
-        if not (model_name.parent).exists():
-            (model_name.parent).mkdir(parents=True)
-        with tqdm(unit="B", unit_scale=True, unit_divisor=1024, miniters=1,
-                desc=(MODEL_PRE_URL + str(model_name.name) + ".zip").rsplit("/",
-                    maxsplit=1)[-1]) as t:
-            reporthook = self.download_progress_hook(t)
-            urlretrieve(MODEL_PRE_URL + str(model_name.name) + ".zip",
-                    str(model_name) + ".zip", reporthook=reporthook, data=None)
-            t.total = t.n
-            with ZipFile(str(model_name) + ".zip", "r") as model_ref:
+    @classmethod
+    def download_model(cls, model_name):
+        model_name.parent.mkdir(parents=True, exist_ok=True)
+        url = MODEL_PRE_URL + str(model_name.name) + ".zip"
+        zip_path = model_name.parent / (model_name.name + ".zip")
+        try:
+            with urlopen(url) as response, open(zip_path, "wb") as fh:
+                total = int(response.headers.get("Content-Length", 0)) or None
+                with tqdm.wrapattr(fh, "write", total=total, miniters=1,
+                        desc=url.rsplit("/", maxsplit=1)[-1]) as out:
+                    shutil.copyfileobj(response, out, length=1 << 20)
+            with ZipFile(zip_path, "r") as model_ref:
                 model_ref.extractall(model_name.parent)
-            Path(str(model_name) + ".zip").unlink()
-
-    def download_progress_hook(self, t):
-        last_b = [0]
-        def update_to(b=1, bsize=1, tsize=None):
-            if tsize not in (None, -1):
-                t.total = tsize
-            displayed = t.update((b - last_b[0]) * bsize)
-            last_b[0] = b
-            return displayed
-        return update_to
+        finally:
+            # Do not leave a partial archive behind if the download fails
+            if zip_path.exists():
+                zip_path.unlink()
 
 class SpkModel:
 
@@ -193,6 +213,9 @@ class KaldiRecognizer:
         _c.vosk_recognizer_set_grm(self._handle, grammar.encode("utf-8"))
 
     def AcceptWaveform(self, data):
+        if not isinstance(data, bytes):
+            # bytearray, memoryview and other buffers are passed without a copy
+            data = _ffi.from_buffer(data)
         res = _c.vosk_recognizer_accept_waveform(self._handle, data, len(data))
         if res < 0:
             raise Exception("Failed to process waveform")
@@ -274,6 +297,8 @@ class BatchRecognizer:
         _c.vosk_batch_recognizer_free(self._handle)
 
     def AcceptWaveform(self, data):
+        if not isinstance(data, bytes):
+            data = _ffi.from_buffer(data)
         res = _c.vosk_batch_recognizer_accept_waveform(self._handle, data, len(data))
 
     def Result(self):
@@ -4,6 +4,7 @@ import argparse
 import logging
 import sys
 import os
+import stat
 
 from pathlib import Path
 from vosk import list_models, list_languages
@@ -40,11 +41,24 @@ parser.add_argument(
         help="optional arg output data type")
 parser.add_argument(
         "--tasks", "-ts", default=10, type=int,
-        help="number of parallel recognition tasks")
+        help="number of parallel recognition tasks, each local task loads its own model")
+parser.add_argument(
+        "--batch", default=False, action="store_true",
+        help="use batch recognition, requires Vosk built with CUDA")
+parser.add_argument(
+        "--profile", default=False, action="store_true",
+        help="print profiling statistics for every recognized file, "\
+            "with --batch for the whole run; not supported with --server")
 parser.add_argument(
         "--log-level", default="INFO",
         help="logging level")
 
+def get_file_list(args):
+    # Keep everything but the last suffix, "a.b.wav" becomes "a.b.txt"
+    with os.scandir(args.input) as entries:
+        return [(Path(e.path), Path(args.output, Path(e.name).stem + "." + args.output_type))
+                for e in entries if e.is_file()]
+
 def main():
 
     args = parser.parse_args()
@@ -63,18 +77,26 @@ def main():
         logging.info("Please specify input file or directory")
         sys.exit(1)
 
-    if not Path(args.input).exists():
-        logging.info("File/folder {args.input} does not exist, "\
-            "please specify an existing file/directory")
+    if args.profile and args.server is not None:
+        logging.info("Profiling is not supported with --server")
+        sys.exit(1)
+
+    if args.tasks < 1:
+        logging.info("Number of tasks must be at least 1")
+        sys.exit(1)
+
+    try:
+        st = os.stat(args.input)
+    except OSError:
+        logging.info("File/folder {} does not exist, "\
+            "please specify an existing file/directory".format(args.input))
         sys.exit(1)
 
     transcriber = Transcriber(args)
 
-    if Path(args.input).is_dir():
-        task_list = [(Path(args.input, fn),
-            Path(args.output,
-            Path(fn).stem).with_suffix("." + args.output_type)) for fn in os.listdir(args.input)]
-    elif Path(args.input).is_file():
+    if stat.S_ISDIR(st.st_mode):
+        task_list = get_file_list(args)
+    elif stat.S_ISREG(st.st_mode):
         if args.output == "":
             task_list = [(Path(args.input), args.output)]
         else:
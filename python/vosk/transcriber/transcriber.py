@@ -1,51 +1,211 @@
+import os
 import json
 import logging
 import asyncio
+import contextlib
+import cProfile
+import pstats
 import websockets
-import srt
-import datetime
 import shlex
+import io
 import subprocess
+import stat
+import sys
+import threading
+import time
+import wave
 
-from vosk import KaldiRecognizer, Model
-from queue import Queue
-from timeit import default_timer as timer
-from multiprocessing.dummy import Pool
+from vosk import KaldiRecognizer, Model, BatchModel, BatchRecognizer, GpuInit
+from queue import Queue, Empty
+from pathlib import Path
+import multiprocessing
+
+if sys.platform == "linux":
+    import fcntl
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 CHUNK_SIZE = 4000
+BUFFER_SIZE = 32000
+PIPE_SIZE = 1 << 20
+QUEUE_SIZE = PIPE_SIZE // BUFFER_SIZE
+PRELOAD_SIZE = 60 * 32000
 SAMPLE_RATE = 16000.0
 
+# Per-process transcriber used by the pool workers
+_worker = None
+_worker_error = None
+
+def _init_pool_worker(args, model_path, log_level):
+    global _worker, _worker_error
+    # Workers started with spawn or forkserver do not inherit the level
+    logging.getLogger().setLevel(log_level)
+    # The pool restarts workers whose initializer raised forever, report
+    # the error from the tasks instead so that pool.map fails
+    try:
+        _worker = Transcriber(args, Model(model_path))
+    except Exception as e:
+        _worker_error = e
+
+def _pool_worker(inputdata):
+    if _worker_error is not None:
+        raise _worker_error
+    with _maybe_profile(_worker.args.profile):
+        _worker.pool_worker(inputdata)
+
+@contextlib.contextmanager
+def _maybe_profile(enabled):
+    # Dumps the hottest functions to stderr, enabled with --profile
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
+
+def srt_timestamp(seconds):
+    # Same rounding as srt.timedelta_to_srt_timestamp(timedelta(seconds=...))
+    secs = int(seconds)
+    usecs = round((seconds - secs) * 1000000)
+    secs, msecs = secs + usecs // 1000000, usecs % 1000000 // 1000
+    hrs, secs = divmod(secs, 3600)
+    mins, secs = divmod(secs, 60)
+    return "{:02d}:{:02d}:{:02d},{:03d}".format(hrs, mins, secs, msecs)
+
+class SrtWriter:
+
+    # Writes subtitles for every result as soon as it is available, so
+    # memory use does not grow with the length of the audio
+    def __init__(self, fh, words_per_line=7):
+        self.fh = fh
+        self.words_per_line = words_per_line
+        self.index = 1
+
+    def write(self, res):
+        if not "result" in res:
+            return
+        words = res["result"]
+        starts = [w["start"] for w in words]
+        ends = [w["end"] for w in words]
+        texts = [w["word"] for w in words]
+
+        for j in range(0, len(words), self.words_per_line):
+            last = min(j + self.words_per_line, len(words)) - 1
+            # srt.compose() drops such lines, skip them without using an index
+            if starts[j] < 0 or ends[last] <= starts[j]:
+                continue
+            self.fh.write("{}\n{} --> {}\n{}\n\n".format(self.index,
+                    srt_timestamp(starts[j]), srt_timestamp(ends[last]),
+                    " ".join(texts[j : j + self.words_per_line])))
+            self.index += 1
+
 class Transcriber:
 
-    def __init__(self, args):
-        self.model = Model(model_path=args.model, model_name=args.model_name, lang=args.lang)
+    def __init__(self, args, model=None):
+        self.model = model
         self.args = args
         self.queue = Queue()
 
-    def recognize_stream(self, rec, stream):
-        tot_samples = 0
-        result = []
+    def get_model_path(self):
+        if self.args.model is not None:
+            return self.args.model
+        return Model.get_model_path(self.args.model_name, self.args.lang)
 
-        while True:
-            data = stream.stdout.read(CHUNK_SIZE)
+    def preload_model(self, model_path):
+        # Ask the kernel to read the model files into the page cache in the
+        # background, so loading the model does not wait on the disk
+        if not hasattr(os, "posix_fadvise"):
+            return
+        for path in Path(model_path).rglob("*"):
+            if not path.is_file():
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+
+    def read_stream(self, stream):
+        # Short files are read with a single call, there is nothing to
+        # overlap with decoding
+        st = os.fstat(stream.fileno())
+        if stat.S_ISREG(st.st_mode) and st.st_size - stream.tell() <= PRELOAD_SIZE:
+            pcm = memoryview(stream.read())
+            for i in range(0, len(pcm), BUFFER_SIZE):
+                yield pcm[i : i + BUFFER_SIZE]
+            return
 
-            if len(data) == 0:
-                break
+        # Read audio in a separate thread so ffmpeg keeps resampling
+        # while the recognizer is busy decoding the previous chunks
+        chunks = Queue(maxsize=QUEUE_SIZE)
+        stop = threading.Event()
 
-            tot_samples += len(data)
-            if rec.AcceptWaveform(data):
-                jres = json.loads(rec.Result())
-                logging.info(jres)
-                result.append(jres)
-            else:
-                jres = json.loads(rec.PartialResult())
-                if jres["partial"] != "":
+        def reader():
+            # Every chunk gets its own buffer, it is handed over to the
+            # recognizer as is instead of being copied into bytes
+            end = None
+            try:
+                while not stop.is_set():
+                    buf = bytearray(BUFFER_SIZE)
+                    n = stream.readinto(buf)
+                    if not n:
+                        break
+                    chunks.put(memoryview(buf)[:n])
+            except Exception as e:
+                end = e
+            finally:
+                chunks.put(end)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            while True:
+                data = chunks.get()
+                if data is None:
+                    break
+                if isinstance(data, Exception):
+                    raise data
+                yield data
+        finally:
+            # Decoding may stop early, unblock the reader and let it exit
+            stop.set()
+            while thread.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except Empty:
+                    pass
+
+    def recognize_stream(self, rec, stream, on_result):
+        tot_samples = 0
+        # Partial results are only fetched to be logged
+        log_partial = logging.getLogger().isEnabledFor(logging.INFO)
+
+        with contextlib.closing(self.read_stream(stream)) as chunks:
+            for data in chunks:
+                tot_samples += len(data)
+                if rec.AcceptWaveform(data):
+                    jres = json_loads(rec.Result())
                     logging.info(jres)
+                    on_result(jres)
+                elif log_partial:
+                    jres = json_loads(rec.PartialResult())
+                    if jres["partial"] != "":
+                        logging.info(jres)
 
-        jres = json.loads(rec.FinalResult())
-        result.append(jres)
+        jres = json_loads(rec.FinalResult())
+        on_result(jres)
 
-        return result, tot_samples
+        return tot_samples
 
     async def recognize_stream_server(self, proc):
         async with websockets.connect(self.args.server) as websocket:
@@ -59,12 +219,12 @@ class Transcriber:
                 if len(data) == 0:
                     break
                 await websocket.send(data)
-                jres = json.loads(await websocket.recv())
+                jres = json_loads(await websocket.recv())
                 logging.info(jres)
                 if not "partial" in jres:
                     result.append(jres)
             await websocket.send('{"eof" : 1}')
-            jres = json.loads(await websocket.recv())
+            jres = json_loads(await websocket.recv())
             logging.info(jres)
             result.append(jres)
 
@@ -74,26 +234,15 @@ class Transcriber:
     def format_result(self, result, words_per_line=7):
         processed_result = ""
         if self.args.output_type == "srt":
-            subs = []
-
-            for _, res in enumerate(result):
-                if not "result" in res:
-                    continue
-                words = res["result"]
-
-                for j in range(0, len(words), words_per_line):
-                    line = words[j : j + words_per_line]
-                    s = srt.Subtitle(index=len(subs),
-                            content = " ".join([l["word"] for l in line]),
-                            start=datetime.timedelta(seconds=line[0]["start"]),
-                            end=datetime.timedelta(seconds=line[-1]["end"]))
-                    subs.append(s)
-            processed_result = srt.compose(subs)
+            fh = io.StringIO()
+            writer = SrtWriter(fh, words_per_line)
+            for res in result:
+                writer.write(res)
+            processed_result = fh.getvalue()
 
         elif self.args.output_type == "txt":
-            for part in result:
-                if part["text"] != "":
-                    processed_result += part["text"] + "\n"
+            processed_result = "".join(part["text"] + "\n" for part in result
+                    if part["text"] != "")
 
         elif self.args.output_type == "json":
             monologues = {"schemaVersion":"2.0", "monologues":[], "text":[]}
@@ -112,16 +261,69 @@ class Transcriber:
         return processed_result
 
     def resample_ffmpeg(self, infile):
-        cmd = shlex.split("ffmpeg -nostdin -loglevel quiet "
-                "-i \'{}\' -ar {} -ac 1 -f s16le -".format(str(infile), SAMPLE_RATE))
+        cmd = shlex.split("ffmpeg -nostdin -hide_banner -nostats -loglevel error "
+                "-i \'{}\' -ar {} -ac 1 -f s16le pipe:1".format(str(infile), SAMPLE_RATE))
         stream = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        if sys.platform == "linux":
+            # Let ffmpeg run ahead of the decoder instead of stalling on
+            # the default 64 KiB pipe
+            try:
+                fcntl.fcntl(stream.stdout.fileno(),
+                        getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_SIZE)
+            except OSError:
+                pass
+        return stream
+
+    def open_wav(self, infile):
+        # Returns the file positioned at the samples if it is a plain
+        # 16 kHz mono 16-bit wav with nothing after the data chunk
+        try:
+            fh = open(infile, "rb")
+        except OSError:
+            return None
+        try:
+            with wave.open(fh) as wf:
+                ready = wf.getnchannels() == 1 and wf.getsampwidth() == 2 \
+                        and wf.getframerate() == SAMPLE_RATE \
+                        and wf.getcomptype() == "NONE" \
+                        and fh.tell() + wf.getnframes() * 2 == os.fstat(fh.fileno()).st_size
+        except (wave.Error, EOFError):
+            ready = False
+        if not ready:
+            fh.close()
+            return None
+        return fh
+
+    def open_audio(self, infile):
+        # Audio that already is in the recognizer format is read directly,
+        # everything else is converted by ffmpeg
+        stream = self.open_wav(infile)
+        if stream is None:
+            stream = self.resample_ffmpeg(infile).stdout
         return stream
 
     async def resample_ffmpeg_async(self, infile):
-        cmd = "ffmpeg -nostdin -loglevel quiet "\
-        "-i \'{}\' -ar {} -ac 1 -f s16le -".format(str(infile), SAMPLE_RATE)
+        cmd = "ffmpeg -nostdin -hide_banner -nostats -loglevel error "\
+        "-i \'{}\' -ar {} -ac 1 -f s16le pipe:1".format(str(infile), SAMPLE_RATE)
         return await asyncio.create_subprocess_shell(cmd, stdout=subprocess.PIPE)
 
+    def write_result(self, output_file, result, tot_samples, start_time):
+        processed_result = self.format_result(result)
+        if output_file != "":
+            logging.info("File {} processing complete".format(output_file))
+            with open(output_file, "w", encoding="utf-8") as fh:
+                fh.write(processed_result)
+        else:
+            print(processed_result)
+
+        self.log_execution_time(start_time, tot_samples)
+
+    def log_execution_time(self, start_time, tot_samples):
+        elapsed = time.perf_counter() - start_time
+        duration = tot_samples / (2 * SAMPLE_RATE)
+        logging.info("Execution time: {:.3f} sec; "\
+                "xRT {:.3f}".format(elapsed, elapsed / duration))
+
     async def server_worker(self):
         while True:
             try:
@@ -130,7 +332,7 @@ class Transcriber:
                 break
 
             logging.info("Recognizing {}".format(input_file))
-            start_time = timer()
+            start_time = time.perf_counter()
             proc = await self.resample_ffmpeg_async(input_file)
             result, tot_samples = await self.recognize_stream_server(proc)
             await proc.wait()
@@ -140,25 +342,15 @@ class Transcriber:
                  self.queue.task_done()
                  continue
 
-            processed_result = self.format_result(result)
-            if output_file != "":
-                logging.info("File {} processing complete".format(output_file))
-                with open(output_file, "w", encoding="utf-8") as fh:
-                    fh.write(processed_result)
-            else:
-                print(processed_result)
-
-            elapsed = timer() - start_time
-            logging.info("Execution time: {:.3f} sec; "\
-                    "xRT {:.3f}".format(elapsed, float(elapsed) * (2 * SAMPLE_RATE) / tot_samples))
+            self.write_result(output_file, result, tot_samples, start_time)
             self.queue.task_done()
 
     def pool_worker(self, inputdata):
         logging.info("Recognizing {}".format(inputdata[0]))
-        start_time = timer()
+        start_time = time.perf_counter()
 
         try:
-            stream = self.resample_ffmpeg(inputdata[0])
+            stream = self.open_audio(inputdata[0])
         except FileNotFoundError as e:
             print(e, "Missing FFMPEG, please install and try again")
             return
@@ -166,23 +358,42 @@ class Transcriber:
             logging.info(e)
             return
 
+        # A new recognizer per file, Reset() keeps the time offset of the
+        # previous files and would shift the word timings
         rec = KaldiRecognizer(self.model, SAMPLE_RATE)
-        rec.SetWords(True)
-        result, tot_samples = self.recognize_stream(rec, stream)
+        # Word timings are only used by the srt and json output
+        rec.SetWords(self.args.output_type in ("srt", "json"))
+
+        with stream:
+            if self.args.output_type == "srt":
+                self.pool_worker_srt(rec, inputdata[1], stream, start_time)
+                return
+
+            result = []
+            tot_samples = self.recognize_stream(rec, stream, result.append)
         if tot_samples == 0:
             return
 
-        processed_result = self.format_result(result)
-        if inputdata[1] != "":
-            logging.info("File {} processing complete".format(inputdata[1]))
-            with open(inputdata[1], "w", encoding="utf-8") as fh:
-                fh.write(processed_result)
+        self.write_result(inputdata[1], result, tot_samples, start_time)
+
+    def pool_worker_srt(self, rec, output_file, stream, start_time):
+        if output_file == "":
+            tot_samples = self.recognize_stream(rec, stream,
+                    SrtWriter(sys.stdout).write)
         else:
-            print(processed_result)
+            with open(output_file, "w", encoding="utf-8") as fh:
+                tot_samples = self.recognize_stream(rec, stream,
+                        SrtWriter(fh).write)
 
-        elapsed = timer() - start_time
-        logging.info("Execution time: {:.3f} sec; "\
-                "xRT {:.3f}".format(elapsed, float(elapsed) * (2 * SAMPLE_RATE) / tot_samples))
+        # Bad input, do not leave an empty file behind
+        if tot_samples == 0:
+            if output_file != "":
+                Path(output_file).unlink()
+            return
+
+        if output_file != "":
+            logging.info("File {} processing complete".format(output_file))
+        self.log_execution_time(start_time, tot_samples)
 
     async def process_task_list_server(self, task_list):
         for x in task_list:
@@ -191,11 +402,89 @@ class Transcriber:
         await asyncio.gather(*workers)
 
     def process_task_list_pool(self, task_list):
-        with Pool() as pool:
-            pool.map(self.pool_worker, task_list)
+        # Resolve (and download if needed) the model once, then load it
+        # in every worker process since the model can not be pickled
+        model_path = self.get_model_path()
+        self.preload_model(model_path)
+        # Every worker loads its own copy of the model, --tasks bounds the
+        # memory used and no more workers than files or cores are started
+        processes = max(1, min(self.args.tasks, os.cpu_count() or 1, len(task_list)))
+        # Files are decoded in parallel processes, keep the math libraries
+        # from starting a thread per core in each of them. The libraries read
+        # these when libvosk is loaded, so the workers are spawned and load
+        # it themselves instead of inheriting the already loaded copy.
+        for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+            os.environ.setdefault(var, "1")
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(processes, initializer=_init_pool_worker,
+                initargs=(self.args, model_path, logging.getLogger().level)) as pool:
+            pool.map(_pool_worker, task_list)
+
+    def process_task_list_batch(self, task_list):
+        GpuInit()
+        model_path = self.get_model_path()
+        self.preload_model(model_path)
+        model = BatchModel(model_path)
+        tasks = iter(task_list)
+        active = []
+
+        while True:
+            # Keep up to args.tasks streams in the batch
+            while len(active) < self.args.tasks:
+                inputdata = next(tasks, None)
+                if inputdata is None:
+                    break
+                logging.info("Recognizing {}".format(inputdata[0]))
+                # Like in the pool, a file that can not be opened is skipped
+                try:
+                    stream = self.open_audio(inputdata[0])
+                except FileNotFoundError as e:
+                    print(e, "Missing FFMPEG, please install and try again")
+                    continue
+                except Exception as e:
+                    logging.info(e)
+                    continue
+                active.append({"output": inputdata[1], "stream": stream,
+                        "rec": BatchRecognizer(model, SAMPLE_RATE), "result": [],
+                        "tot_samples": 0, "finished": False, "start_time": time.perf_counter()})
+
+            if len(active) == 0:
+                break
+
+            # Feed in the data
+            for task in active:
+                if task["finished"]:
+                    continue
+                data = task["stream"].read(CHUNK_SIZE)
+                if len(data) == 0:
+                    task["rec"].FinishStream()
+                    task["stream"].close()
+                    task["finished"] = True
+                    continue
+                task["rec"].AcceptWaveform(data)
+                task["tot_samples"] += len(data)
+
+            model.Wait()
+
+            # Retrieve results and write out completed streams
+            for task in active:
+                while True:
+                    res = task["rec"].Result()
+                    if len(res) == 0:
+                        break
+                    task["result"].append(json_loads(res))
+                if task["finished"] and task["rec"].GetPendingChunks() == 0 \
+                        and task["tot_samples"] > 0:
+                    self.write_result(task["output"], task["result"],
+                            task["tot_samples"], task["start_time"])
+            active = [task for task in active
+                    if not task["finished"] or task["rec"].GetPendingChunks() > 0]
 
     def process_task_list(self, task_list):
-        if self.args.server is None:
+        if self.args.server is None and self.args.batch:
+            with _maybe_profile(self.args.profile):
+                self.process_task_list_batch(task_list)
+        elif self.args.server is None:
             self.process_task_list_pool(task_list)
         else:
             asyncio.run(self.process_task_list_server(task_list))